@@ -1,10 +1,27 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import os
-from PIL import Image
 
 # FastAPI Backend URL
 API_URL = "https://new-aticha-production.up.railway.app"
+FRAMED_FOLDER = "./framed_images"
+
+
+@st.cache_resource
+def get_session():
+    """ One pooled HTTP session shared across Streamlit reruns """
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+    return session
+
+
+@st.cache_data(ttl=5)
+def list_framed_images(folder_mtime):
+    """ Framed images from oldest to newest, rescanned only when the folder changes """
+    entries = [entry for entry in os.scandir(FRAMED_FOLDER) if entry.name.endswith((".png", ".jpg", ".jpeg"))]
+    return [entry.name for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime)]
+
 
 st.title("🎨 Artcha Image Processing Automation")
 st.write("Automates downloading, framing, and packaging MidJourney images.")
@@ -24,9 +41,10 @@ if st.button("Run Automation"):
     progress_bar.progress(0)  # Start Progress at 0%
 
     try:
-        response = requests.get(
+        response = get_session().get(
             f"{API_URL}/run?frame_color={frame_color[1:]}&frame_size={frame_size}&force_download={force_download}",
-            stream=True
+            stream=True,
+            timeout=(5, None)
         )
 
         if response.status_code == 200:
@@ -64,18 +82,18 @@ if st.button("Run Automation"):
         st.error(f"❌ Error: {e}")
 
 # 📷 **Show Image Preview AFTER Processing**
-if os.path.exists("./framed_images") and os.listdir("./framed_images"):
-    st.subheader("📷 Processed Image Preview")
-    images = [file for file in os.listdir("./framed_images") if file.endswith((".png", ".jpg", ".jpeg"))]
+if os.path.exists(FRAMED_FOLDER):
+    images = list_framed_images(os.path.getmtime(FRAMED_FOLDER))
 
     if images:
-        latest_image = os.path.join("./framed_images", images[-1])
-        st.image(Image.open(latest_image), caption="Latest Processed Image", use_container_width=True)
+        st.subheader("📷 Processed Image Preview")
+        latest_image = os.path.join(FRAMED_FOLDER, images[-1])
+        st.image(latest_image, caption="Latest Processed Image", use_container_width=True)
 
 # 📦 **Download Processed Images**
 if st.button("Download Processed Images"):
     with st.spinner("Zipping images..."):
-        response = requests.get(f"{API_URL}/download")
+        response = get_session().get(f"{API_URL}/download", timeout=(5, 30))
         if response.status_code == 200:
             with open(response.json()["download_url"], "rb") as file:
                 st.download_button("📥 Download ZIP", file, file_name="framed_images.zip", mime="application/zip")
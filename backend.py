@@ -1,19 +1,40 @@
 from fastapi import FastAPI, Query, HTTPException
 from fastapi.responses import StreamingResponse
 import os
-import json
-import requests
-import subprocess
+import mmap
+import orjson
+import asyncio
+import threading
+import httpx
+import aiofiles
 import glob
 import cv2
-from zipfile import ZipFile
+import numpy as np
+from contextlib import asynccontextmanager
+from datetime import datetime
+from zipfile import ZipFile, ZIP_STORED
+from stream_zip import stream_zip, ZIP_AUTO
 from dotenv import load_dotenv
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 
 # Load environment variables from .env file
 load_dotenv()
 
-app = FastAPI()
+# Shared HTTP client so every download reuses pooled CDN connections across runs
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+    timeout=httpx.Timeout(30, connect=5),
+)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await http_client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Configuration
 json_file = "Art_images.json"
@@ -22,11 +43,25 @@ framed_folder = "./framed_images"
 downloaded_log = "./downloaded_images.log"
 zip_output = "./framed_images.zip"
 
+# Maximum number of attachments downloaded at the same time
+download_concurrency = 16
+# Buffer size for streaming image bytes over the network and to/from disk
+chunk_size = 1 << 16
+# Longest exporter output line read in one go; progress bar redraws can make for very long lines
+exporter_line_limit = 1 << 20
+# Framed canvases each framing thread keeps for reuse, one per distinct image size
+max_cached_canvases = 4
+
 # Securely load Discord credentials from .env file
 discord_exporter_path = "./DiscordChatExporter.CLI"
 discord_token = os.getenv("DISCORD_TOKEN")
 channel_id = os.getenv("DISCORD_CHANNEL_ID")
 
+# Parallelism comes from the framing thread pool, so keep OpenCV itself single-threaded
+# to avoid oversubscribing the cores
+cv2.setNumThreads(1)
+cv2.ocl.setUseOpenCL(False)
+
 # Ensure folders exist
 os.makedirs(download_folder, exist_ok=True)
 os.makedirs(framed_folder, exist_ok=True)
@@ -38,39 +73,159 @@ if not os.path.exists(downloaded_log):
 
 def load_downloaded_images(force_download=False):
     """ Load already downloaded images unless force_download is enabled """
-    if force_download:
-        return set()
-    if os.path.exists(downloaded_log):
-        with open(downloaded_log, "r") as f:
-            return set(f.read().splitlines())
-    return set()
+    if force_download or not os.path.exists(downloaded_log) or os.path.getsize(downloaded_log) == 0:
+        return frozenset()
+    # Walk the mapped log line by line so the whole file and its split list never sit in memory next to the set
+    with open(downloaded_log, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return frozenset(line.rstrip(b"\r\n").decode() for line in iter(mm.readline, b""))
+
+
+def read_export():
+    """ Reads and parses the renamed Discord export """
+    with open(json_file, "rb") as file:
+        return orjson.loads(file.read())
+
+
+def append_downloaded_log(filenames):
+    """ Records newly downloaded images so later runs skip them """
+    with open(downloaded_log, "a", buffering=1 << 16) as log_file:
+        log_file.writelines(f"{filename}\n" for filename in filenames)
+
+
+def read_zip_names():
+    """ Names already in the ZIP file, or None if it does not exist yet """
+    if not os.path.exists(zip_output):
+        return None
+    with ZipFile(zip_output) as zipf:
+        return set(zipf.namelist())
 
 
 def hex_to_bgr(hex_color):
     """ Convert HEX color to BGR format for OpenCV """
     hex_color = hex_color.lstrip("#")
-    rgb = tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
-    return (rgb[2], rgb[1], rgb[0])  # Convert RGB to BGR
-
-
-def apply_frame(params):
-    """ Applies a frame to the given image file """
-    filename, frame_size, frame_color = params
-    input_path = os.path.join(download_folder, filename)
-    output_path = os.path.join(framed_folder, filename)
-    
-    img = cv2.imread(input_path)
-    if img is None:
-        return f"⚠️ Skipping {filename} (invalid image)"
-    
-    border_color = hex_to_bgr(frame_color)
-    
-    img_with_border = cv2.copyMakeBorder(
-        img, frame_size, frame_size, frame_size, frame_size,
-        cv2.BORDER_CONSTANT, value=border_color
-    )
-    cv2.imwrite(output_path, img_with_border)
-    return f"✅ Framed: {filename}"
+    if len(hex_color) != 6:
+        raise ValueError(f"Expected a 6-digit HEX color, got {hex_color!r}")
+    value = int(hex_color, 16)
+    return (value & 0xFF, (value >> 8) & 0xFF, (value >> 16) & 0xFF)  # Blue, green, red
+
+
+# Leading magic bytes of the image formats OpenCV reads and writes (WebP is matched separately)
+image_signatures = (
+    b"\x89PNG\r\n\x1a\n",  # PNG
+    b"\xff\xd8\xff",  # JPEG
+    b"BM",  # BMP
+    b"II*\x00",  # TIFF, little-endian
+    b"MM\x00*",  # TIFF, big-endian
+    b"P1", b"P2", b"P3", b"P4", b"P5", b"P6", b"P7",  # PBM/PGM/PPM, plain and raw, and PAM
+    b"PF", b"Pf",  # PFM
+    b"\x00\x00\x00\x0cjP  ",  # JPEG 2000
+    b"\x59\xa6\x6a\x95",  # Sun raster
+    b"#?RADIANCE", b"#?RGBE",  # Radiance HDR
+    b"v/1\x01",  # OpenEXR
+)
+
+
+def has_image_signature(path):
+    """ Checks the file's magic bytes against the image formats OpenCV handles, without decoding it """
+    try:
+        with open(path, "rb") as f:
+            head = f.read(12)
+    except OSError:
+        return False
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return True
+    return head.startswith(image_signatures)
+
+
+def make_framer(frame_size, border_color):
+    """ Builds an apply_frame specialized for one run's frame size and color """
+    border = np.array(border_color, dtype=np.uint8)
+    # Framed canvases are reused per worker thread and input shape, so the border is
+    # painted once and each image only rewrites the interior
+    local = threading.local()
+
+    def apply_frame(filename):
+        """ Applies the frame to the given image file """
+        input_path = os.path.join(download_folder, filename)
+        output_path = os.path.join(framed_folder, filename)
+
+        if not has_image_signature(input_path):
+            return f"⚠️ Skipping {filename} (invalid image)"
+
+        img = cv2.imread(input_path)
+        if img is None:
+            return f"⚠️ Skipping {filename} (invalid image)"
+
+        canvases = getattr(local, "canvases", None)
+        if canvases is None or len(canvases) >= max_cached_canvases:
+            canvases = local.canvases = {}
+
+        h, w = img.shape[:2]
+        img_with_border = canvases.get(img.shape)
+        if img_with_border is None:
+            img_with_border = np.empty((h + 2 * frame_size, w + 2 * frame_size, 3), dtype=np.uint8)
+            img_with_border[...] = border
+            canvases[img.shape] = img_with_border
+        img_with_border[frame_size:frame_size + h, frame_size:frame_size + w] = img
+
+        # Encode in memory so the framed image hits the disk in a single write
+        try:
+            ok, encoded = cv2.imencode(os.path.splitext(filename)[1], img_with_border, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        except cv2.error:
+            # Raised rather than returned when the extension is missing or has no encoder
+            ok = False
+        if not ok:
+            return f"⚠️ Skipping {filename} (could not encode image)"
+        with open(output_path, "wb") as f:
+            f.write(encoded)
+        return f"✅ Framed: {filename}"
+
+    return apply_frame
+
+
+async def download_image(semaphore, url, filename):
+    """ Downloads a single attachment, returning an error message if it failed """
+    file_path = os.path.join(download_folder, filename)
+
+    async with semaphore:
+        try:
+            async with http_client.stream("GET", url) as response:
+                if response.status_code != 200:
+                    return f"⚠️ Failed to download {url}: HTTP {response.status_code}"
+                async with aiofiles.open(file_path, "wb") as img_file:
+                    async for chunk in response.aiter_bytes(chunk_size):
+                        await img_file.write(chunk)
+        except Exception as e:
+            return f"⚠️ Error downloading {url}: {e}"
+    return None
+
+
+async def download_and_frame(semaphore, executor, framer, url, filename, progress):
+    """ Downloads one attachment and frames it as soon as it lands, reporting each step to the progress queue """
+    error = await download_image(semaphore, url, filename)
+    await progress.put(("download", filename, error))
+    if error is None:
+        loop = asyncio.get_running_loop()
+        # Always report a frame result, since the drain loop in event_stream waits for one
+        try:
+            result = await loop.run_in_executor(executor, framer, filename)
+        except Exception as e:
+            result = f"⚠️ Skipping {filename} ({e})"
+        await progress.put(("frame", filename, result))
+
+
+def iter_framed_files():
+    """ Yields stream_zip member tuples for every framed image, read in chunk_size blocks """
+    def read_chunks(path):
+        with open(path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+
+    for file in sorted(os.listdir(framed_folder)):
+        path = os.path.join(framed_folder, file)
+        stat = os.stat(path)
+        # Deflate at level 0, since stream-zip's stored modes need the CRC up front
+        yield file, datetime.fromtimestamp(stat.st_mtime), stat.st_mode, ZIP_AUTO(stat.st_size, level=0), read_chunks(path)
 
 
 @app.get("/")
@@ -79,8 +234,8 @@ def home():
 
 
 @app.get("/run")
-def run_automation(
-    frame_color: str = Query(default="000000"), 
+async def run_automation(
+    frame_color: str = Query(default="000000", pattern="^#?[0-9a-fA-F]{6}$"), 
     frame_size: int = Query(default=30), 
     force_download: bool = Query(default=False)
 ):
@@ -89,11 +244,11 @@ def run_automation(
     if not discord_token or not channel_id:
         return HTTPException(status_code=500, detail="Missing Discord credentials.")
 
-    downloaded_images = load_downloaded_images(force_download)
+    downloaded_images = await asyncio.to_thread(load_downloaded_images, force_download)
     new_downloads = []
     new_images = 0  # ✅ Initialize new_images properly
 
-    def event_stream():
+    async def event_stream():
         nonlocal new_images  # ✅ Fix scope issue
 
         yield "🚀 Starting automation...\n"
@@ -101,78 +256,140 @@ def run_automation(
 
         # Step 1: Run DiscordChatExporter
         export_command = [discord_exporter_path, "export", "-t", discord_token, "-c", channel_id, "-f", "Json"]
-        subprocess.run(export_command)
+        proc = await asyncio.create_subprocess_exec(
+            *export_command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            limit=exporter_line_limit,
+        )
+        try:
+            # Forward the exporter's own progress instead of going quiet until it exits
+            while True:
+                try:
+                    raw_line = await proc.stdout.readuntil(b"\n")
+                except asyncio.IncompleteReadError as e:
+                    raw_line = e.partial  # Last line without a trailing newline, or b"" at EOF
+                except asyncio.LimitOverrunError:
+                    # No newline within the limit, so pass the buffered output on as a chunk
+                    raw_line = await proc.stdout.read(exporter_line_limit)
+                if not raw_line:
+                    break
+
+                line = raw_line.decode(errors="ignore").rstrip()
+                if line:
+                    yield f"{line}\n"
+            await proc.wait()
+        finally:
+            # The client may disconnect mid-export, so never leave the exporter running
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
         yield "✅ Discord export complete.\n"
 
         # Step 2: Rename JSON file
-        json_files = glob.glob("*art_channel*.json")
+        # File work below runs in worker threads so large exports and archives never stall the event loop
+        json_files = await asyncio.to_thread(glob.glob, "*art_channel*.json")
         if json_files:
-            os.rename(json_files[0], json_file)
+            await asyncio.to_thread(os.rename, json_files[0], json_file)
             yield f"✅ Found JSON file: {json_files[0]}\n"
         else:
             yield "⚠️ JSON file not found. Aborting.\n"
             return
 
-        # Step 3: Download new images
+        # Step 3: Read the export
         try:
-            with open(json_file, "r", encoding="utf-8") as file:
-                data = json.load(file)
+            data = await asyncio.to_thread(read_export)
         except Exception as e:
             yield f"⚠️ Error reading JSON: {e}\n"
             return
 
-        total_images = len(data.get("messages", []))
+        messages = data.get("messages", [])
+        total_images = len(messages)
         downloaded_count = 0
 
-        for message in data.get("messages", []):
-            for attachment in message.get("attachments", []):
-                url, filename = attachment.get("url", ""), attachment.get("fileName", "")
-
-                if not url or filename in downloaded_images:
-                    continue  
-
-                file_path = os.path.join(download_folder, filename)
-                try:
-                    response = requests.get(url, stream=True)
-                    if response.status_code == 200:
-                        with open(file_path, "wb") as img_file:
-                            for chunk in response.iter_content(1024):
-                                img_file.write(chunk)
+        # Keyed by filename so an attachment posted twice is only downloaded once
+        tasks = list({
+            attachment["fileName"]: attachment["url"]
+            for message in messages
+            for attachment in message.get("attachments", ())
+            if attachment.get("url") and attachment.get("fileName")
+            and attachment["fileName"] not in downloaded_images
+        }.items())
+
+        # Step 4: Download and frame as one pipeline, so each image is framed as soon as it lands
+        # while the remaining downloads carry on
+        progress = asyncio.Queue()
+        semaphore = asyncio.Semaphore(download_concurrency)
+        framer = make_framer(frame_size, hex_to_bgr(frame_color))
+        framed_filenames = []
+        framed_count = 0
+        failed_downloads = 0
+
+        if tasks:
+            yield "🖼️ Applying frames to images as they download...\n"
+
+        # OpenCV releases the GIL while decoding and encoding, so threads run in parallel
+        # without the fork and pickling cost of a process pool
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            pipeline = asyncio.gather(*[
+                download_and_frame(semaphore, executor, framer, url, filename, progress)
+                for filename, url in tasks
+            ])
+            try:
+                # Every attachment reports its download, and successful downloads also report framing
+                pending = len(tasks)
+                while pending:
+                    step, filename, message = await progress.get()
+                    pending -= 1
+
+                    if step == "download":
+                        if message:
+                            failed_downloads += 1
+                            yield f"{message}\n"
+                            continue
+
+                        pending += 1
                         new_downloads.append(filename)
                         new_images += 1
                         downloaded_count += 1
                         yield f"⬇️ Downloading {downloaded_count}/{total_images}: {filename}\n"
                     else:
-                        yield f"⚠️ Failed to download {url}: HTTP {response.status_code}\n"
-                except Exception as e:
-                    yield f"⚠️ Error downloading {url}: {e}\n"
+                        framed_count += 1
+                        # Every attachment that has not failed to download will reach the framer
+                        yield f"🎨 Framing {framed_count}/{len(tasks) - failed_downloads}: {message}\n"
+                        if "✅ Framed" in message:
+                            framed_filenames.append(filename)
+                await pipeline
+            finally:
+                pipeline.cancel()
 
         if new_downloads:
-            with open(downloaded_log, "a") as log_file:
-                log_file.write("\n".join(new_downloads) + "\n")
-
-        # Step 4: Apply frames to new images
-        framed_images = 0
-        pool_args = [(filename, frame_size, frame_color) for filename in new_downloads]
+            await asyncio.to_thread(append_downloaded_log, new_downloads)
 
-        if new_images > 0:
-            yield "🖼️ Applying frames to images...\n"
-            with Pool() as pool:
-                results = pool.map(apply_frame, pool_args)
+        framed_images = len(framed_filenames)
 
-            for idx, result in enumerate(results):
-                yield f"🎨 Framing {idx+1}/{new_images}: {result}\n"
-                if "✅ Framed" in result:
-                    framed_images += 1
-
-        # Step 5: Create ZIP file
+        # Step 5: Create or update ZIP file
         if framed_images > 0:
-            with ZipFile(zip_output, 'w') as zipf:
-                for file in os.listdir(framed_folder):
-                    zipf.write(os.path.join(framed_folder, file), file)
+            archived = await asyncio.to_thread(read_zip_names)
+
+            # Only append the newly framed images, unless the archive is missing or
+            # one of them replaces an entry that is already in it
+            if archived is None or archived.intersection(framed_filenames):
+                mode, files = "w", sorted(await asyncio.to_thread(os.listdir, framed_folder))
+            else:
+                mode, files = "a", framed_filenames
+
+            # Framed images are already compressed, so store them as-is instead of deflating.
+            # Each file is written in a worker thread so progress still streams per file
+            zipf = await asyncio.to_thread(ZipFile, zip_output, mode, compression=ZIP_STORED, allowZip64=True)
+            try:
+                for file in files:
+                    await asyncio.to_thread(zipf.write, os.path.join(framed_folder, file), file)
                     yield f"📦 Added to ZIP: {file}\n"
+            finally:
+                await asyncio.to_thread(zipf.close)
 
-            yield f"✅ ZIP file created: {zip_output}\n"
+            yield f"✅ ZIP file {'created' if mode == 'w' else 'updated'}: {zip_output}\n"
         else:
             yield "⚠️ No images were framed, skipping ZIP creation.\n"
 
@@ -187,3 +404,13 @@ def download_zip():
     if os.path.exists(zip_output):
         return {"download_url": zip_output}
     return {"error": "No ZIP file found"}
+
+
+@app.get("/download/stream")
+def download_zip_stream():
+    """ Streams a ZIP of the framed images without building it on disk first """
+    return StreamingResponse(
+        stream_zip(iter_framed_files()),
+        media_type="application/zip",
+        headers={"Content-Disposition": "attachment; filename=framed_images.zip"},
+    )